@@ -8,15 +8,199 @@ import csv
 import time
 import sys
 import re
+import itertools
+import multiprocessing
+import threading
+import BaseHTTPServer
+import socket
+import collections
+import gzip
+import random
+import array
+import mmap
+import struct
+import signal
+import cProfile
+import pstats
+import gc
+import resource
+import hashlib
+import multiprocessing.pool
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 # Version
 _version_ = "0.1.4"
 
+# FASTQ index definitions
+# <reads>.fastq.fqi holds a header (magic, read count, indexed fastq size), one fixed width
+# (name offset, record offset, record length) entry per read sorted by read ID, then the read IDs.
+index_suffix = '.fqi'
+index_magic = 'FQI1'
+index_header = struct.Struct('<4sQQ')
+index_entry = struct.Struct('<QQI')
+
+def fastq_records(handle):
+    while True:
+        record = ''.join(itertools.islice(handle, 4))
+        if not record:
+            return
+        yield record
+
+class FastqIndexer(object):
+    # Collects read offsets as records are streamed into a fastq, indexing any existing content first
+    def __init__(self, fastq):
+        self.fastq = fastq
+        self.names = []
+        self.offsets = array.array('L')
+        self.lengths = array.array('L')
+        self.position = 0
+        if os.path.exists(fastq) and os.path.getsize(fastq) > 0:
+            with open(fastq, 'r') as existing:
+                for record in fastq_records(existing):
+                    self.add(record)
+
+    def add(self, record):
+        if record.startswith('@'):
+            self.names.append(record[1:].split(None, 1)[0])
+            self.offsets.append(self.position)
+            self.lengths.append(len(record))
+        self.position += len(record)
+
+    def write(self):
+        order = sorted(range(len(self.names)), key=self.names.__getitem__)
+        temp = self.fastq + index_suffix + '.tmp'
+        with open(temp, 'wb') as out:
+            out.write(index_header.pack(index_magic, len(order), self.position))
+            name_offset = 0
+            for position in order:
+                out.write(index_entry.pack(name_offset, self.offsets[position], self.lengths[position]))
+                name_offset += len(self.names[position]) + 1
+            for position in order:
+                out.write(self.names[position] + '\n')
+        os.rename(temp, self.fastq + index_suffix)
+
+def stream_fastq(source, destination, indexer, digest=None):
+    # Copies records between open handles, returning the number of bytes written
+    written = 0
+    for record in fastq_records(source):
+        destination.write(record)
+        indexer.add(record)
+        if digest is not None:
+            digest.update(record)
+        written += len(record)
+    return written
+
+def copy_fastq(source, destination, digest=None):
+    with open(source, 'r') as in1:
+        with open(destination, 'w') as out:
+            indexer = FastqIndexer(destination)
+            stream_fastq(in1, out, indexer, digest)
+    indexer.write()
+
+def index_fastq(fastq):
+    indexer = FastqIndexer(fastq)
+    indexer.write()
+    return len(indexer.names)
+
+class FastqIndex(object):
+    # Memory maps a fastq and its index for random access to reads by ID
+    def __init__(self, fastq):
+        self.fastq = fastq
+        with open(fastq + index_suffix, 'rb') as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count, size = index_header.unpack_from(self.index, 0)
+        if magic != index_magic:
+            raise ValueError('Not a PoreCycler fastq index: ' + fastq + index_suffix)
+        if size != os.path.getsize(fastq):
+            raise ValueError('Index is out of date, rebuild it with: porecycler.py fetch --build ' + fastq)
+        self.names_start = index_header.size + self.count * index_entry.size
+        self.reads = None
+        if size > 0:
+            with open(fastq, 'rb') as f:
+                self.reads = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, read_id):
+        return self.find(read_id) >= 0
+
+    def entry(self, position):
+        return index_entry.unpack_from(self.index, index_header.size + position * index_entry.size)
+
+    def name(self, position):
+        start = self.names_start + self.entry(position)[0]
+        return self.index[start:self.index.find('\n', start)]
+
+    def names(self):
+        for position in range(self.count):
+            yield self.name(position)
+
+    def find(self, read_id):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.name(middle) < read_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self.name(low) == read_id:
+            return low
+        return -1
+
+    def fetch(self, read_id):
+        position = self.find(read_id)
+        if position < 0:
+            raise KeyError(read_id)
+        offset, length = self.entry(position)[1:]
+        return self.reads[offset:offset + length]
+
+def fetch_main(argv):
+    fetcher = argparse.ArgumentParser(prog='porecycler.py fetch', description="Random access to reads in fastqs indexed by PoreCycler")
+    fetcher.add_argument("fastq", help="Path to a fastq in raw_fastqs/ or porechopped/ (or any fastq indexed with --build)")
+    fetcher.add_argument("read_ids", nargs='*', help="Read IDs to print in fastq format")
+    fetcher.add_argument("--count", action="store_true", help="Print the number of indexed reads")
+    fetcher.add_argument("--list", action="store_true", help="Print every indexed read ID")
+    fetcher.add_argument("--build", action="store_true", help="(Re)build the index for the fastq before anything else")
+    options = fetcher.parse_args(argv)
+    if not os.path.isfile(options.fastq):
+        sys.stderr.write('Fastq not found: ' + options.fastq + '\n')
+        return 1
+    try:
+        if options.build:
+            index_fastq(options.fastq)
+        index = FastqIndex(options.fastq)
+    except (IOError, OSError, ValueError) as e:
+        sys.stderr.write(str(e) + '\n')
+        return 1
+    if options.count:
+        print len(index)
+    if options.list:
+        for name in index.names():
+            print name
+    missing = 0
+    for read_id in options.read_ids:
+        try:
+            sys.stdout.write(index.fetch(read_id))
+        except KeyError:
+            sys.stderr.write('Read not found: ' + read_id + '\n')
+            missing += 1
+    if missing:
+        return 1
+    return 0
+
+# Fetch subcommand, e.g. porecycler.py fetch porechopped/Sample_NB01.fastq <read_id>
+if len(sys.argv) > 1 and sys.argv[1] == 'fetch':
+    sys.exit(fetch_main(sys.argv[2:]))
+
 # Argparse argument setup
 parser = argparse.ArgumentParser(description="Hands free MinION data processing using Porechop for barcode trimming/binning, and Unicycler for assembly")
 requiredargs = parser.add_argument_group('required arguments')
-requiredargs.add_argument("-i", "--input", required=True, help="Path to CSV file containing list of barcodes and their corresponding sample name")
-requiredargs.add_argument("-f", "--fastq", required=True, help="Path to directory containing raw basecalled data generated by Albacore in fastq format")
+requiredargs.add_argument("-i", "--input", required=True, help="Path to CSV file containing list of barcodes and their corresponding sample name (with -u, may instead be a previous output directory or its samples.tsv)")
+requiredargs.add_argument("-f", "--fastq", help="Path to directory containing raw basecalled data generated by Albacore in fastq format (not needed when -u is given a previous run)")
 requiredargs.add_argument("-o", "--output", required=True, help="Path to output destination")
 parser.add_argument("-p", "--porechop", action="store_true", help="Run Porechop and rename/collect files only (i.e. no assembly)")
 parser.add_argument("-u", "--unicycler", action="store_true", help="Run Unicycler and rename/collect files only (i.e. no adapter trimming)")
@@ -27,6 +211,23 @@ parser.add_argument("-m", "--merge", action="store_true", help="Merges 'Unclassi
 parser.add_argument("-cons", "--conservative", action="store_true", help="Runs unicycler in conservative mode")
 parser.add_argument("-bold", "--bold", action="store_true", help="Runs unicycler in bold mode")
 parser.add_argument("-r", "--remove", action="store_true", help="Removes intermediate files")
+parser.add_argument("-ck", "--chunk", action="store_true", help="Splits large concatenated fastqs into chunks and runs porechop on them in parallel")
+parser.add_argument("-k", "--keep_going", action="store_true", help="Continues with the remaining samples when Porechop or Unicycler fails for a sample")
+parser.add_argument("--retries", type=int, default=0, help="Number of times a failed Porechop or Unicycler job is retried (default: 0)")
+parser.add_argument("--retry_mode", choices=['same', 'conservative', 'threads'], default='threads', help="How Unicycler is retried: unchanged, in conservative mode, or with half the threads each attempt (default: threads)")
+parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of Porechop or Unicycler jobs to run at once (default: 1)")
+parser.add_argument("-ss", "--subsample", action="store_true", help="Subsamples paired Illumina reads to a target depth before hybrid assembly")
+parser.add_argument("--depth", type=float, default=100, help="Target Illumina depth for --subsample, requires --genome_size or per-sample genome sizes in the input file (default: 100)")
+parser.add_argument("--bases", help="Target number of Illumina bases for --subsample, e.g. 500m (overrides --depth)")
+parser.add_argument("-gs", "--genome_size", help="Expected genome size, e.g. 5m or 5000000")
+parser.add_argument("-mc", "--min_coverage", type=float, help="Minimum long read coverage (read bases / genome size) for a sample to be assembled, requires a genome size")
+parser.add_argument("--gate", choices=['skip', 'defer'], default='skip', help="What happens to samples under --min_coverage: not assembled, or assembled after every other sample (default: skip)")
+parser.add_argument("--seed", type=int, default=1, help="Random seed for --subsample (default: 1)")
+parser.add_argument("--manifest", action="store_true", help="Writes MANIFEST.tsv with the size and checksum of every collected output file")
+parser.add_argument("--checksum", choices=['sha256', 'sha1', 'md5', 'xxh64'], default='sha256', help="Checksum used by --manifest (default: sha256, xxh64 requires the xxhash module)")
+parser.add_argument("--profile", action="store_true", help="Profiles PoreCycler's own stages (concatenation, merges, copies) and writes the results to a profile folder in the output directory")
+parser.add_argument("--metrics", help="Path to a Prometheus text format file updated periodically with run progress")
+parser.add_argument("--metrics_port", type=int, help="Serves run progress in Prometheus text format on this local port")
 args = parser.parse_args()
 
 # Colour set up
@@ -43,15 +244,66 @@ class Logger(object):
     def __init__(self):
         self.terminal = sys.stdout
         self.log = open("PoreCycler.log", "w")
+        self.lock = threading.Lock()
 
     def write(self, message):
-        self.terminal.write(message)
-        self.log.write(re.sub(ansi_rm, '', message))
+        with self.lock:
+            self.terminal.write(message)
+            self.log.write(re.sub(ansi_rm, '', message))
+
+    def flush(self):
+        with self.lock:
+            self.terminal.flush()
+            self.log.flush()
 
 sys.stdout = Logger()
 
+# Sample manifest definitions (chained -u runs)
+sample_manifest = 'samples.tsv'
+sample_manifest_columns = ['sample', 'barcode', 'reads', 'illumina_r1', 'illumina_r2', 'genome_size']
+
+def find_sample_manifest(path):
+    # Accepts a previous output directory or its samples.tsv, returns None for a plain input CSV
+    if os.path.isdir(path):
+        path = os.path.join(path, sample_manifest)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        if f.readline().rstrip('\r\n').split('\t') != sample_manifest_columns:
+            return None
+    return os.path.abspath(path)
+
+def write_sample_manifest(names, barcodes, reads, r1s, r2s, genome_sizes):
+    # Read paths are stored relative to the output directory so it can be moved as a whole
+    with open(out_path + '/' + sample_manifest, 'w') as out:
+        out.write('\t'.join(sample_manifest_columns) + '\n')
+        for row in zip(names, barcodes, reads, r1s, r2s, genome_sizes):
+            out.write('\t'.join([row[0], row[1], os.path.relpath(row[2], out_path), row[3] or '', row[4] or '', row[5] or '']) + '\n')
+
+def load_sample_manifest(path):
+    with open(path, 'r') as f:
+        rows = list(csv.DictReader(f, delimiter='\t'))
+    manifest_dir = os.path.dirname(path)
+    for row in rows:
+        row['reads'] = os.path.join(manifest_dir, row['reads'])
+    return rows
+
+chained = None
+if args.unicycler:
+    chained = find_sample_manifest(args.input)
+unchained = args.unicycler and not chained and os.path.isdir(args.input)
+
+# Input syntax check
+if args.fastq is None and not chained and not unchained:
+    print colours.warning + ''
+    print 'Please supply the path to your MinION reads using -f <path>'
+    print ''
+    print 'This is only optional when running Unicycler only (-u) on a previous PoreCycler output directory'
+    print '' + colours.term
+    sys.exit(1)
+
 # Hybrid syntax check
-if args.hybrid and args.sbs is None:
+if args.hybrid and args.sbs is None and not chained:
     print colours.warning + ''
     print 'You have chosen a hybrid assembly.'
     print ''
@@ -81,8 +333,46 @@ if args.conservative and args.bold:
     print '' + colours.term
     sys.exit(1)
 
+# Subsample syntax check
+if args.subsample and not args.hybrid:
+    print colours.warning + ''
+    print 'Illumina subsampling (-ss) is only used for hybrid assemblies.'
+    print ''
+    print 'Please add the -hyb flag or remove the -ss flag'
+    print '' + colours.term
+    sys.exit(1)
+if args.min_coverage is not None and args.genome_size is None:
+    print colours.warning + ''
+    print 'Note: no global genome size (-gs) was given for --min_coverage.'
+    print 'Only samples with a genome size in the last column of the input file will be gated.'
+    print '' + colours.term
+if args.subsample and args.bases is None and args.genome_size is None:
+    print colours.warning + ''
+    print 'Note: no global genome size (-gs) or --bases was given for Illumina subsampling.'
+    print 'Every sample will need a genome size in the last column of the input file.'
+    print '' + colours.term
+
+# Job syntax check
+if args.retries < 0 or args.jobs < 1:
+    print colours.warning + ''
+    print 'The number of retries (--retries) cannot be negative and at least one job (-j) must run at once.'
+    print ''
+    print 'Please use --retries 0 or more and -j 1 or more'
+    print '' + colours.term
+    sys.exit(1)
+
+# Checksum syntax check
+if args.manifest and args.checksum == 'xxh64' and xxhash is None:
+    print colours.warning + ''
+    print 'xxh64 checksums require the xxhash python module.'
+    print ''
+    print 'Install it with: pip install xxhash, or choose another --checksum'
+    print '' + colours.term
+    sys.exit(1)
+
 # Repetitive element definitions
-def scriptfail():
+def scriptfail(code=1):
+    final_metrics(code)
     print ''
     print colours.bold + '#############'
     print 'Script Failed'
@@ -104,6 +394,874 @@ def csverror():
     print 'If your input file contains the correct information, column 4 may be followed by a trailing comma'
     print 'e.g "A, B, C, D," - please change it to "A, B, C, D" and try again.'
 
+def split_genome_sizes(rows, columns):
+    # An optional extra column gives a sample its own expected genome size, rows without it get None
+    if rows and all(len(x) in (columns, columns + 1) for x in rows):
+        return [x[:columns] for x in rows], [(x[columns:] or [None])[0] or None for x in rows]
+    return rows, [None] * len(rows)
+
+def check_genome_sizes(genome_sizes, code):
+    # Fails on a per-sample genome size parse_size cannot read, before any sample is processed
+    for size in genome_sizes:
+        if size is None:
+            continue
+        try:
+            parse_size(size)
+        except ValueError as e:
+            print ''
+            print colours.warning + 'A per-sample genome size could not be read.'
+            print 'Sizes are plain numbers of bases, optionally followed by k, m or g, e.g. 5m' + colours.term
+            print ''
+            print (e)
+            print ''
+            print code
+            scriptfail()
+            sys.exit(1)
+    if args.subsample and not args.bases and not args.genome_size and None in genome_sizes:
+        print ''
+        print colours.warning + str(genome_sizes.count(None)) + ' sample(s) have no genome size to set an Illumina subsampling target from.'
+        print 'Add a genome size to the last column of the input file, or use -gs <size> or --bases <size>' + colours.term
+        print ''
+        print code
+        scriptfail()
+        sys.exit(1)
+
+# Illumina subsampling definitions (-ss)
+def parse_size(size):
+    # Accepts plain integers or k/m/g suffixed sizes, e.g. 5m or 2.8g
+    text = str(size).strip().lower().rstrip('b')
+    multiplier = {'k': 1000, 'm': 1000000, 'g': 1000000000}.get(text[-1:], 1)
+    if multiplier != 1:
+        text = text[:-1]
+    try:
+        value = int(float(text) * multiplier)
+    except (ValueError, OverflowError):
+        raise ValueError('Could not read size: ' + str(size))
+    if value <= 0:
+        raise ValueError('Size must be greater than zero: ' + str(size))
+    return value
+
+def open_reads(path, mode='r'):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b', 1)
+    return open(path, mode)
+
+def read_pairs(r1, r2):
+    # Yields synchronised four line records from both files, failing if either runs out early
+    with open_reads(r1) as in1:
+        with open_reads(r2) as in2:
+            while True:
+                record1 = list(itertools.islice(in1, 4))
+                record2 = list(itertools.islice(in2, 4))
+                if not record1 and not record2:
+                    return
+                if len(record1) != 4 or len(record2) != 4:
+                    raise ValueError('Illumina read files are not paired: ' + r1 + ', ' + r2)
+                yield record1, record2
+
+def pair_name(header):
+    name = header.split()[0]
+    if name.endswith('/1') or name.endswith('/2'):
+        name = name[:-2]
+    return name
+
+def subsample_pair(job):
+    r1, r2, out1, out2, target, seed = job
+    total = 0
+    for record1, record2 in read_pairs(r1, r2):
+        if pair_name(record1[0]) != pair_name(record2[0]):
+            raise ValueError('Illumina reads out of sync at ' + record1[0].strip() + ' / ' + record2[0].strip())
+        total += len(record1[1].rstrip()) + len(record2[1].rstrip())
+    if total <= target:
+        return r1, r2, total, total
+    fraction = float(target) / total
+    chooser = random.Random(seed)
+    kept = 0
+    with open_reads(out1, 'w') as opt1:
+        with open_reads(out2, 'w') as opt2:
+            for record1, record2 in read_pairs(r1, r2):
+                if chooser.random() < fraction:
+                    opt1.write(''.join(record1))
+                    opt2.write(''.join(record2))
+                    kept += len(record1[1].rstrip()) + len(record2[1].rstrip())
+    return out1, out2, kept, total
+
+def subsample_target(size=None):
+    # --bases is the same for every sample, otherwise depth times the sample's own genome size or -gs
+    if args.bases:
+        return parse_size(args.bases)
+    return int(args.depth * parse_size(size or args.genome_size))
+
+def pool_map(function, jobs):
+    pool = multiprocessing.Pool(max(1, min(len(jobs), free_cores())))
+    try:
+        # get() with a timeout keeps the pool interruptible with ctrl-c
+        return pool.map_async(function, jobs).get(60 * 60 * 24 * 7)
+    finally:
+        pool.terminate()
+
+def subsample_illumina(r1s, r2s, targets):
+    subdir = out_path + '/illumina_subsampled'
+    if not os.path.exists(subdir):
+        os.mkdir(subdir)
+    outs = [subdir + '/' + os.path.basename(x) + ('' if x.endswith('.gz') else '.gz') for x in r1s + r2s]
+    jobs = [(w, x, y, z, t, args.seed) for w, x, y, z, t in zip(r1s, r2s, outs[:len(r1s)], outs[len(r1s):], targets)]
+    subsampled = pool_map(subsample_pair, jobs)
+    for result in subsampled:
+        print colours.blue + 'Illumina bases kept: ' + colours.term + str(result[2]) + '/' + str(result[3]),
+        print os.path.basename(result[0])
+    return [x[0] for x in subsampled], [x[1] for x in subsampled]
+
+def subsample_stage():
+    print ''
+    targets = [subsample_target(x) for x in genome_sizes]
+    if len(set(targets)) == 1:
+        print colours.invoking + 'Subsampling Illumina reads to ' + str(targets[0]) + ' bases...' + colours.term
+    else:
+        print colours.invoking + 'Subsampling Illumina reads to ' + str(args.depth) + 'x of each genome size...' + colours.term
+    print ''
+    try:
+        subsampled = subsample_illumina(Illumina_R1, Illumina_R2, targets)
+    except Exception as e:
+        print colours.warning + ''
+        print 'Failed to subsample Illumina reads'
+        print ''
+        print (e)
+        print '#S1'
+        print ''
+        scriptfail()
+        sys.exit(1)
+    print ''
+    print colours.blue + 'Subsampled Illumina reads written to: ' + colours.term,
+    print out_path + '/illumina_subsampled'
+    print ''
+    return subsampled
+
+# Metrics definitions (--metrics / --metrics_port)
+metrics_interval = 15
+
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stage_totals = {}
+        self.stage_done = {}
+        self.stage_failed = {}
+        self.stage_started = {}
+        self.bytes_concatenated = 0
+        self.children = {}
+        self.exit_code = None
+
+    def begin(self, stage, total):
+        with self.lock:
+            self.stage_totals[stage] = total
+            self.stage_done[stage] = 0
+            self.stage_failed[stage] = 0
+            self.stage_started[stage] = time.time()
+
+    def done(self, stage):
+        with self.lock:
+            self.stage_done[stage] = self.stage_done.get(stage, 0) + 1
+
+    def add_bytes(self, count):
+        with self.lock:
+            self.bytes_concatenated += count
+
+    def register(self, child):
+        with self.lock:
+            self.children[child.pid] = child
+
+    def release(self, child):
+        with self.lock:
+            self.children.pop(child.pid, None)
+
+    def eta(self):
+        # Remaining samples at the mean pace of the samples each stage has finished so far,
+        # failed and cancelled samples count as finished so a stage with failures still ends
+        remaining = 0.0
+        known = False
+        now = time.time()
+        for stage, total in self.stage_totals.items():
+            done = self.stage_done[stage] + self.stage_failed[stage]
+            if done == 0 or done >= total:
+                continue
+            remaining += (now - self.stage_started[stage]) / done * (total - done)
+            known = True
+        if not known:
+            return -1
+        return remaining
+
+    def render(self):
+        with self.lock:
+            lines = ['# HELP porecycler_samples_total Samples queued per pipeline stage',
+                     '# TYPE porecycler_samples_total gauge']
+            for stage in sorted(self.stage_totals):
+                lines.append('porecycler_samples_total{stage="' + stage + '"} ' + str(self.stage_totals[stage]))
+            lines.append('# HELP porecycler_samples_done Samples completed per pipeline stage')
+            lines.append('# TYPE porecycler_samples_done gauge')
+            for stage in sorted(self.stage_totals):
+                lines.append('porecycler_samples_done{stage="' + stage + '"} ' + str(self.stage_done[stage]))
+            lines.append('# HELP porecycler_samples_failed Samples failed or cancelled per pipeline stage')
+            lines.append('# TYPE porecycler_samples_failed gauge')
+            for stage in sorted(self.stage_totals):
+                lines.append('porecycler_samples_failed{stage="' + stage + '"} ' + str(self.stage_failed[stage]))
+            lines.append('# TYPE porecycler_bytes_concatenated_total counter')
+            lines.append('porecycler_bytes_concatenated_total ' + str(self.bytes_concatenated))
+            pids = list(self.children)
+            eta = self.eta()
+            exit_code = self.exit_code
+        cpu, rss = child_usage(pids)
+        lines.append('# TYPE porecycler_child_processes gauge')
+        lines.append('porecycler_child_processes ' + str(len(pids)))
+        lines.append('# HELP porecycler_child_cpu_seconds CPU time of running children and their descendants')
+        lines.append('# TYPE porecycler_child_cpu_seconds gauge')
+        lines.append('porecycler_child_cpu_seconds ' + '%.2f' % cpu)
+        lines.append('# HELP porecycler_child_rss_bytes Resident memory of running children and their descendants')
+        lines.append('# TYPE porecycler_child_rss_bytes gauge')
+        lines.append('porecycler_child_rss_bytes ' + str(rss))
+        lines.append('# TYPE porecycler_uptime_seconds gauge')
+        lines.append('porecycler_uptime_seconds ' + '%.0f' % (time.time() - self.started))
+        lines.append('# HELP porecycler_eta_seconds Estimated time remaining, -1 when unknown')
+        lines.append('# TYPE porecycler_eta_seconds gauge')
+        lines.append('porecycler_eta_seconds ' + '%.0f' % eta)
+        lines.append('# HELP porecycler_exit_code Exit status of a finished run, -1 while running')
+        lines.append('# TYPE porecycler_exit_code gauge')
+        lines.append('porecycler_exit_code ' + str(-1 if exit_code is None else exit_code))
+        lines.append('# TYPE porecycler_last_update_timestamp_seconds gauge')
+        lines.append('porecycler_last_update_timestamp_seconds ' + '%.0f' % time.time())
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def child_usage(pids):
+    # Sums CPU and RSS over each child and all of its descendants using /proc (Linux only)
+    if not pids or not os.path.exists('/proc/self/stat'):
+        return 0.0, 0
+    stats = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/' + entry + '/stat', 'r') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        stats[int(entry)] = (int(fields[1]), int(fields[11]) + int(fields[12]), int(fields[21]))
+    tree = set(pids)
+    grown = True
+    while grown:
+        grown = False
+        for pid, stat in stats.items():
+            if stat[0] in tree and pid not in tree:
+                tree.add(pid)
+                grown = True
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    pagesize = os.sysconf('SC_PAGE_SIZE')
+    cpu = sum(stats[x][1] for x in tree if x in stats) / ticks
+    rss = sum(stats[x][2] for x in tree if x in stats) * pagesize
+    return cpu, rss
+
+def write_metrics(path):
+    temp = path + '.tmp'
+    with open(temp, 'w') as f:
+        f.write(metrics.render())
+    os.rename(temp, path)
+
+def final_metrics(code):
+    # Last --metrics update on every way out, so a failed run is not left looking stalled
+    metrics.exit_code = code
+    if args.metrics:
+        try:
+            write_metrics(os.path.abspath(args.metrics))
+        except (IOError, OSError):
+            pass
+
+def metrics_writer(path):
+    while True:
+        try:
+            write_metrics(path)
+        except (IOError, OSError):
+            pass
+        time.sleep(metrics_interval)
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics():
+    if args.metrics:
+        writer = threading.Thread(target=metrics_writer, args=(os.path.abspath(args.metrics),))
+        writer.daemon = True
+        writer.start()
+    if args.metrics_port:
+        try:
+            server = BaseHTTPServer.HTTPServer(('127.0.0.1', args.metrics_port), MetricsHandler)
+        except socket.error as e:
+            print colours.warning + ''
+            print 'Could not serve metrics on port ' + str(args.metrics_port) + ', is it already in use?'
+            print ''
+            print (e)
+            print '#M1'
+            print '' + colours.term
+            scriptfail()
+            sys.exit(1)
+        serving = threading.Thread(target=server.serve_forever)
+        serving.daemon = True
+        serving.start()
+
+# Child process definitions
+summary_interval = 30
+
+class Child(object):
+    # Runs a tool with stdout/stderr drained by background threads into a timestamped per-sample log
+    def __init__(self, command, name):
+        self.command = command
+        self.name = name
+        self.tool = os.path.basename(command[0])
+        self.logpath = child_log_path + '/' + name + '_' + self.tool + '.log'
+        self.log = open(self.logpath, 'a')
+        self.lock = threading.Lock()
+        self.tail = collections.deque(maxlen=20)
+        self.last_summary = time.time()
+        self.log.write(timestamp() + ' [porecycler] ' + ' '.join(command) + '\n')
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, preexec_fn=os.setpgrp)
+        self.pid = self.process.pid
+        metrics.register(self.process)
+        self.drains = [threading.Thread(target=self.drain, args=(self.process.stdout, 'stdout')),
+                       threading.Thread(target=self.drain, args=(self.process.stderr, 'stderr'))]
+        for drain in self.drains:
+            drain.daemon = True
+            drain.start()
+
+    def drain(self, pipe, stream):
+        for line in iter(pipe.readline, ''):
+            # Progress bars redraw with carriage returns, only the final state is kept
+            line = re.sub(ansi_rm, '', line.rstrip('\r\n').split('\r')[-1])
+            if not line.strip():
+                continue
+            with self.lock:
+                self.log.write(timestamp() + ' [' + stream + '] ' + line + '\n')
+                self.tail.append(line)
+                if time.time() - self.last_summary < summary_interval:
+                    continue
+                self.last_summary = time.time()
+            sys.stdout.write(colours.blue + self.name + ' (' + self.tool + '): ' + colours.term + line[:120] + '\n')
+        pipe.close()
+
+    def wait(self):
+        returncode = self.process.wait()
+        for drain in self.drains:
+            drain.join()
+        metrics.release(self.process)
+        self.log.write(timestamp() + ' [porecycler] exited with code ' + str(returncode) + '\n')
+        self.log.close()
+        if returncode != 0:
+            sys.stdout.write(colours.warning + self.name + ' (' + self.tool + ') failed, last output:' + colours.term + '\n')
+            sys.stdout.write(''.join('    ' + x + '\n' for x in self.tail))
+        sys.stdout.write(colours.blue + self.name + ' (' + self.tool + ') log: ' + colours.term + self.logpath + '\n')
+        return returncode
+
+def timestamp():
+    return time.strftime('%Y-%m-%d %H:%M:%S')
+
+def stop_children():
+    with metrics.lock:
+        children = list(metrics.children.values())
+    for child in children:
+        try:
+            os.killpg(child.pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+def check_child(command, name, stage=None):
+    returncode = Child(command, name).wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, ' '.join(command))
+    if stage:
+        metrics.done(stage)
+
+# Job supervisor definitions (-k / --retries / -j)
+# Children run in their own process groups, so ctrl-c is handled here and passed on to them
+results = {}
+result_names = []
+result_stages = []
+stopping = threading.Event()
+interrupted = threading.Event()
+
+def record(name, stage, status):
+    with metrics.lock:
+        if name not in result_names:
+            result_names.append(name)
+        if stage not in result_stages:
+            result_stages.append(stage)
+        if status in ('FAIL', 'CANCELLED') and stage in metrics.stage_failed:
+            metrics.stage_failed[stage] += 1
+        results[(name, stage)] = status
+
+def passed(name, stage):
+    return results.get((name, stage)) in ('PASS', 'RETRIED')
+
+def keep_passed(stage, names, *lists):
+    # Filters parallel lists down to the samples that passed a stage
+    keep = [x for x, y in enumerate(names) if passed(y, stage)]
+    return [[z[x] for x in keep] for z in lists]
+
+def interrupt(signum, frame):
+    interrupted.set()
+    stopping.set()
+    if not metrics.children:
+        raise KeyboardInterrupt
+    stop_children()
+
+def run_job(stage, name, run, errors):
+    for attempt in range(args.retries + 1):
+        if stopping.is_set():
+            record(name, stage, 'CANCELLED')
+            return
+        try:
+            run(attempt)
+        except Exception as e:
+            if stopping.is_set():
+                record(name, stage, 'CANCELLED')
+                return
+            sys.stdout.write(colours.warning + name + ' (' + stage + ') failed on attempt ' + str(attempt + 1) + ': ' + colours.term + str(e) + '\n')
+            error = e
+            continue
+        record(name, stage, 'PASS' if attempt == 0 else 'RETRIED')
+        return
+    record(name, stage, 'FAIL')
+    errors.append(error)
+    if not args.keep_going:
+        stopping.set()
+        stop_children()
+
+def supervise(stage, jobs):
+    # Runs (name, run) jobs on worker threads, run(attempt) raising on failure
+    queue = collections.deque(jobs)
+    errors = []
+    for name, run in jobs:
+        if name not in result_names:
+            result_names.append(name)
+    def worker():
+        while True:
+            with metrics.lock:
+                if not queue or stopping.is_set():
+                    return
+                name, run = queue.popleft()
+            run_job(stage, name, run, errors)
+    workers = [threading.Thread(target=worker) for x in range(max(1, min(args.jobs, len(jobs))))]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    # Polling rather than join() keeps the main thread responsive to ctrl-c
+    while any(x.is_alive() for x in workers):
+        time.sleep(0.2)
+    for name, run in queue:
+        record(name, stage, 'CANCELLED')
+    if interrupted.is_set():
+        print ''
+        print colours.warning + 'Interrupted, running jobs were stopped.' + colours.term
+        run_summary()
+        scriptfail(130)
+        sys.exit(130)
+    if errors and not args.keep_going:
+        run_summary()
+        raise errors[0]
+
+def unicycler_mode():
+    if args.conservative:
+        return 'conservative'
+    if args.bold:
+        return 'bold'
+    return None
+
+def unicycler_code():
+    # Matches the #E1-#E6 codes of the long read/hybrid and normal/conservative/bold pathways
+    return '#E' + str(1 + (3 if args.hybrid else 0) + (1 if args.conservative else 0) + (2 if args.bold else 0))
+
+def unicycler_command(longreads, outdir, r1, r2, attempt):
+    mode = unicycler_mode()
+    threads = None
+    if args.jobs > 1:
+        threads = max(1, multiprocessing.cpu_count() // args.jobs)
+    if attempt > 0 and args.retry_mode == 'conservative':
+        mode = 'conservative'
+    if attempt > 0 and args.retry_mode == 'threads':
+        threads = max(1, (threads or min(multiprocessing.cpu_count(), 8)) // 2 ** attempt)
+    command = ['unicycler']
+    if mode:
+        command += ['--mode', mode]
+    if r1:
+        command += ['-1', r1, '-2', r2]
+    command += ['-l', longreads, '-o', outdir]
+    if threads:
+        command += ['--threads', str(threads)]
+    return command
+
+def unicycler_job(longreads, outdir, r1=None, r2=None):
+    def run(attempt):
+        # Unicycler reuses files it finds in its output directory, so retries start clean
+        if attempt > 0 and os.path.exists(outdir):
+            shutil.rmtree(outdir)
+        check_child(unicycler_command(longreads, outdir, r1, r2, attempt), os.path.basename(outdir), 'unicycler')
+    return os.path.basename(outdir), run
+
+def porechop_job(fastq, destination):
+    def run(attempt):
+        porechop(fastq, destination)
+    return os.path.basename(fastq)[:-len('.fastq')], run
+
+def run_summary():
+    if not results:
+        return
+    width = max(len(x) for x in result_names + ['Sample'])
+    print ''
+    print colours.bold + 'Run summary:' + colours.term
+    print 'Sample'.ljust(width) + ''.join('  ' + x.ljust(10) for x in result_stages) + ('  coverage' if sample_stats else '')
+    for name in result_names:
+        print name.ljust(width) + ''.join('  ' + results.get((name, x), '-').ljust(10) for x in result_stages) + ('  ' + stats_columns(name)[3] if sample_stats else '')
+    with open(out_path + '/run_summary.tsv', 'w') as out:
+        out.write('\t'.join(['sample'] + result_stages + (['reads', 'bases', 'n50', 'coverage'] if sample_stats else [])) + '\n')
+        for name in result_names:
+            out.write('\t'.join([name] + [results.get((name, x), '-') for x in result_stages] + (stats_columns(name) if sample_stats else [])) + '\n')
+    print ''
+    print colours.blue + 'Run summary written to: ' + colours.term,
+    print out_path + '/run_summary.tsv'
+
+def failed_samples(stage=None):
+    # -k lets a run finish with failed or cancelled samples, these decide its banners and exit status
+    stages = [stage] if stage else result_stages
+    return [x for x in result_names if any(results.get((x, y)) in ('FAIL', 'CANCELLED') for y in stages)]
+
+def completion_message(tool, stage):
+    failed = failed_samples(stage)
+    if failed:
+        return colours.warning + tool + ' completed with ' + str(len(failed)) + ' failed sample(s): ' + ', '.join(failed)
+    return tool + ' completed successfully!'
+
+def completion_banner():
+    failed = failed_samples()
+    message = 'PoreCycler Complete!'
+    if failed:
+        message = 'PoreCycler completed with ' + str(len(failed)) + ' failed sample(s)'
+    print (colours.warning if failed else '') + colours.bold + ''
+    print '#' * len(message)
+    print message
+    print '#' * len(message) + colours.term
+    return failed
+
+# Coverage gate definitions (-mc / --gate)
+sample_stats = {}
+
+def read_stats(fastq):
+    # Streams a fastq once for read count, total bases and N50
+    lengths = array.array('L')
+    with open(fastq, 'r') as in1:
+        for record in fastq_records(in1):
+            lengths.append(len(record.split('\n', 2)[1]))
+    bases = sum(lengths)
+    n50 = 0
+    running = 0
+    for length in sorted(lengths, reverse=True):
+        running += length
+        if running * 2 >= bases:
+            n50 = length
+            break
+    return len(lengths), bases, n50
+
+def stats_columns(name):
+    stats = sample_stats.get(name)
+    if stats is None:
+        return ['-', '-', '-', '-']
+    coverage = '-' if stats[3] is None else '%.1fx' % stats[3]
+    return [str(stats[0]), str(stats[1]), str(stats[2]), coverage]
+
+def coverage_gate(jobs, longreads, genome_sizes):
+    # Skips or defers Unicycler jobs whose long reads fall short of --min_coverage
+    print ''
+    print colours.invoking + 'Checking long read coverage...' + colours.term
+    print ''
+    stats = pool_map(read_stats, longreads)
+    admitted = []
+    deferred = []
+    for job, stat, size in zip(jobs, stats, genome_sizes):
+        name = job[0]
+        size = size or args.genome_size
+        coverage = None
+        if size:
+            coverage = float(stat[1]) / parse_size(size)
+        sample_stats[name] = stat + (coverage,)
+        print colours.blue + name + ': ' + colours.term + str(stat[0]) + ' reads, ' + str(stat[1]) + ' bases, N50 ' + str(stat[2]) + ', coverage ' + stats_columns(name)[3]
+        if coverage is None or coverage >= args.min_coverage:
+            record(name, 'gate', 'PASS')
+            admitted.append(job)
+        elif args.gate == 'defer':
+            record(name, 'gate', 'DEFER')
+            deferred.append(job)
+        else:
+            record(name, 'gate', 'SKIP')
+    skipped = len(jobs) - len(admitted) - len(deferred)
+    metrics.begin('unicycler', len(admitted) + len(deferred))
+    if skipped or deferred:
+        print ''
+        print colours.warning + str(skipped) + ' sample(s) skipped and ' + str(len(deferred)) + ' deferred for coverage under ' + str(args.min_coverage) + 'x' + colours.term
+    print ''
+    return admitted + deferred
+
+# Profiling definitions (--profile)
+# Python 2 has no tracemalloc, so allocations are summarised as peak RSS growth and growth in
+# gc tracked objects by type. Only the main thread is profiled; children have their own logs.
+profiles = {}
+
+def object_counts():
+    counts = collections.defaultdict(int)
+    for item in gc.get_objects():
+        counts[type(item).__name__] += 1
+    return counts
+
+def profile_start(stage):
+    if not args.profile:
+        return
+    counts = object_counts()
+    profiler = cProfile.Profile()
+    profiles[stage] = (profiler, counts, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, time.time())
+    profiler.enable()
+
+def profile_stop(stage):
+    if not args.profile:
+        return
+    profiler, counts, maxrss, started = profiles.pop(stage)
+    profiler.disable()
+    elapsed = time.time() - started
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    growth = object_counts()
+    growth = sorted(((growth[x] - counts.get(x, 0), x) for x in growth), reverse=True)[:20]
+    profiledir = out_path + '/profile'
+    if not os.path.exists(profiledir):
+        os.mkdir(profiledir)
+    profiler.dump_stats(profiledir + '/' + stage + '.pstats')
+    with open(profiledir + '/' + stage + '_allocations.txt', 'w') as out:
+        out.write('stage\t' + stage + '\n')
+        out.write('wall_seconds\t' + '%.2f' % elapsed + '\n')
+        out.write('peak_rss_kb_before\t' + str(maxrss) + '\n')
+        out.write('peak_rss_kb_after\t' + str(peak) + '\n')
+        out.write('\nObjects gained by type:\n')
+        for count, name in growth:
+            if count > 0:
+                out.write(str(count).rjust(12) + '  ' + name + '\n')
+        out.write('\nTop functions by cumulative time:\n')
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(20)
+    sys.stdout.write(colours.blue + 'Profiled ' + stage + ' (' + '%.1f' % elapsed + 's): ' + colours.term + profiledir + '/' + stage + '.pstats\n')
+
+# Manifest definitions (--manifest)
+# Files PoreCycler writes itself are hashed as they are streamed, anything else is hashed in a thread pool
+manifest = {}
+manifest_dirs = ['porechopped', 'assembly_fasta', 'assembly_graphs', 'assembly_logs']
+
+def new_digest():
+    if not args.manifest:
+        return None
+    if args.checksum == 'xxh64':
+        return xxhash.xxh64()
+    return hashlib.new(args.checksum)
+
+def manifest_add(path, digest):
+    if digest is not None:
+        manifest[os.path.normpath(path)] = (os.path.getsize(path), digest.hexdigest())
+
+def collect_file(source, destination):
+    digest = new_digest()
+    if digest is None:
+        shutil.copyfile(source, destination)
+        return
+    with open(source, 'rb') as in1:
+        with open(destination, 'wb') as out:
+            for block in iter(lambda: in1.read(1024 * 1024), ''):
+                digest.update(block)
+                out.write(block)
+    manifest_add(destination, digest)
+
+def hash_file(path):
+    digest = new_digest()
+    with open(path, 'rb') as in1:
+        for block in iter(lambda: in1.read(1024 * 1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def write_manifest():
+    if not args.manifest:
+        return
+    paths = []
+    for folder in manifest_dirs:
+        for root, dirs, files in os.walk(out_path + '/' + folder):
+            paths += [os.path.normpath(os.path.join(root, x)) for x in files]
+    pending = [x for x in paths if x not in manifest or manifest[x][0] != os.path.getsize(x)]
+    if pending:
+        # hashlib releases the GIL on large blocks, so threads hash files in parallel
+        pool = multiprocessing.pool.ThreadPool(min(len(pending), free_cores()))
+        try:
+            digests = pool.map(hash_file, pending)
+        finally:
+            pool.close()
+        for path, digest in zip(pending, digests):
+            manifest[path] = (os.path.getsize(path), digest)
+    with open(out_path + '/MANIFEST.tsv', 'w') as out:
+        out.write('path\tsize\t' + args.checksum + '\n')
+        for path in sorted(paths):
+            out.write(os.path.relpath(path, out_path) + '\t' + str(manifest[path][0]) + '\t' + manifest[path][1] + '\n')
+    print ''
+    print colours.blue + 'Checksums for ' + str(len(paths)) + ' files (' + str(len(paths) - len(pending)) + ' hashed while writing) written to: ' + colours.term,
+    print out_path + '/MANIFEST.tsv'
+
+# Chunked porechop definitions (-ck)
+chunk_floor = 1024 * 1024 * 1024
+
+def free_cores():
+    cores = multiprocessing.cpu_count()
+    try:
+        busy = int(os.getloadavg()[0])
+    except OSError:
+        busy = 0
+    return max(1, cores - busy)
+
+def chunk_count(fastq, cores):
+    # One chunk per gigabyte, capped by the cores currently free
+    return int(max(1, min(cores, os.path.getsize(fastq) // chunk_floor)))
+
+def split_fastq(fastq, chunks, chunkdir):
+    # Splits on four line record boundaries into contiguous chunks of similar size
+    target = os.path.getsize(fastq) // chunks + 1
+    chunkpaths = [chunkdir + '/chunk' + str(x) + '.fastq' for x in range(chunks)]
+    current = 0
+    written = 0
+    with open(fastq, 'r') as in1:
+        out = open(chunkpaths[current], 'w')
+        for record in fastq_records(in1):
+            if written >= target and current < chunks - 1:
+                out.close()
+                current += 1
+                written = 0
+                out = open(chunkpaths[current], 'w')
+            out.write(record)
+            written += len(record)
+        out.close()
+    return chunkpaths[:current + 1]
+
+def merge_bins(chunkouts, destination):
+    # Rebuilds the BCxx.fastq / none.fastq layout porechop would have written
+    # The destination may hold other files (e.g. unclassified.fastq), so only stale bins are replaced
+    if not os.path.exists(destination):
+        os.mkdir(destination)
+    bins = set()
+    for chunkout in chunkouts:
+        if os.path.exists(chunkout):
+            bins.update(x for x in os.listdir(chunkout) if x.endswith('.fastq'))
+    for filename in bins:
+        if os.path.exists(os.path.join(destination, filename)):
+            os.remove(os.path.join(destination, filename))
+    for chunkout in chunkouts:
+        if not os.path.exists(chunkout):
+            continue
+        for filename in sorted(os.listdir(chunkout)):
+            if not filename.endswith('.fastq'):
+                continue
+            with open(os.path.join(chunkout, filename), 'r') as in1:
+                with open(os.path.join(destination, filename), 'a') as out:
+                    shutil.copyfileobj(in1, out)
+
+def porechop_chunked(fastq, destination):
+    cores = free_cores()
+    if args.jobs > 1:
+        # Other -j jobs are chunking at the same time, so each gets its share of the free cores
+        cores = max(1, cores // args.jobs)
+    chunks = chunk_count(fastq, cores)
+    name = os.path.basename(fastq)[:-len('.fastq')]
+    if chunks < 2:
+        check_child(['porechop', '-i', fastq, '-b', destination], name)
+        return
+    chunkdir = destination + '_chunks'
+    if os.path.exists(chunkdir):
+        shutil.rmtree(chunkdir)
+    os.mkdir(chunkdir)
+    chunkpaths = split_fastq(fastq, chunks, chunkdir)
+    chunkouts = [x[:-len('.fastq')] + '_porechopped' for x in chunkpaths]
+    threads = str(max(1, cores // len(chunkpaths)))
+    print colours.blue + 'Porechopping ' + str(len(chunkpaths)) + ' chunks of: ' + colours.term,
+    print fastq
+    children = [Child(['porechop', '-i', x, '-b', y, '--threads', threads], name + '_chunk' + str(index)) for index, (x, y) in enumerate(zip(chunkpaths, chunkouts))]
+    returncodes = [x.wait() for x in children]
+    for returncode in returncodes:
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, 'porechop -i ' + fastq)
+    merge_bins(chunkouts, destination)
+    shutil.rmtree(chunkdir)
+
+def porechop(fastq, destination):
+    if args.chunk:
+        porechop_chunked(fastq, destination)
+    else:
+        check_child(['porechop', '-i', fastq, '-b', destination], os.path.basename(fastq)[:-len('.fastq')])
+    metrics.done('porechop')
+
+# Sample manifest check
+if unchained:
+    print colours.warning + ''
+    print 'No PoreCycler sample manifest (' + sample_manifest + ') was found in: ' + os.path.abspath(args.input)
+    print ''
+    print 'Point -i at a previous PoreCycler output directory, or at an input CSV'
+    print '#IU6'
+    print '' + colours.term
+    scriptfail()
+    sys.exit(1)
+
+# Genome size check
+if args.genome_size:
+    try:
+        parse_size(args.genome_size)
+    except ValueError as e:
+        print colours.warning + ''
+        print 'Could not read the expected genome size (-gs)'
+        print 'Sizes are plain numbers of bases, optionally followed by k, m or g, e.g. 5m'
+        print ''
+        print (e)
+        print '#I3'
+        print '' + colours.term
+        scriptfail()
+        sys.exit(1)
+
+# Subsample target check
+if args.subsample:
+    try:
+        if args.depth <= 0:
+            raise ValueError('Depth must be greater than zero: ' + str(args.depth))
+        if args.bases:
+            parse_size(args.bases)
+    except ValueError as e:
+        print colours.warning + ''
+        print 'Could not set an Illumina subsampling target from --bases / -gs / --depth'
+        print 'Sizes are plain numbers of bases, optionally followed by k, m or g, e.g. 500m'
+        print ''
+        print (e)
+        print '#S2'
+        print '' + colours.term
+        scriptfail()
+        sys.exit(1)
+
+# Start optional metrics exporter
+start_metrics()
+
+# Stop child processes cleanly on ctrl-c
+signal.signal(signal.SIGINT, interrupt)
+
 # Welcome message:
 print ''
 print ''
@@ -120,19 +1278,27 @@ if not os.path.exists(args.output):
 
 # Directory orientation
 invoked_from = os.getcwd()
-os.chdir(args.fastq)
-target_path = os.getcwd()
-os.chdir(invoked_from)
+if chained:
+    target_path = os.path.dirname(chained)
+else:
+    os.chdir(args.fastq)
+    target_path = os.getcwd()
+    os.chdir(invoked_from)
 os.chdir(args.output)
 out_path = os.getcwd()
 os.chdir(invoked_from)
+
+# Create directory for Porechop and Unicycler logs before any jobs run in parallel
+child_log_path = out_path + '/child_logs'
+if not os.path.exists(child_log_path):
+    os.mkdir(child_log_path)
 print ''
 print colours.blue + "Invoked from: " + colours.term,
 print invoked_from
 print ''
 print colours.blue + "MinION reads in: " + colours.term,
 print target_path
-if args.hybrid:
+if args.hybrid and not chained:
     os.chdir(args.sbs)
     sbspath = os.getcwd()
     os.chdir(invoked_from)
@@ -155,7 +1321,8 @@ if not args.unicycler:
         try:
             with open(args.input, 'rbU') as f:
                 reader = csv.reader(f, skipinitialspace=True, delimiter=',')
-                a, b, c, d = zip(*reader)
+                rows, genome_sizes = split_genome_sizes(list(reader), 4)
+                a, b, c, d = zip(*rows)
                 barcodes = list(a)
                 samples = list(b)
                 Ill_R1 = list(c)
@@ -190,7 +1357,8 @@ if not args.unicycler:
             try:
                 with open(args.input, 'rbU') as f:
                     reader = csv.reader(f, skipinitialspace=True, delimiter=',')
-                    a, b = zip(*reader)
+                    rows, genome_sizes = split_genome_sizes(list(reader), 2)
+                    a, b = zip(*rows)
                     barcodes = list(a)
                     samples = list(b)
                     print ''
@@ -235,6 +1403,7 @@ if not args.unicycler:
                         print ''
                         scriptfail()
                         sys.exit(1)
+    check_genome_sizes(genome_sizes, '#I4')
 
     # Create directory in output destination for raw concatenated fastq's
     catfastq = out_path + '/raw_fastqs'
@@ -287,13 +1456,19 @@ if not args.unicycler:
     print ''
     print colours.invoking + 'Concatenating Reads...' + colours.term
     print ''
+    metrics.begin('concatenate', len(albacore_wildcard))
+    profile_start('concatenate')
     for index, directory in enumerate(albacore_wildcard):
         output_fastqs = rawfastqs[index]
+        indexer = FastqIndexer(output_fastqs)
         for filename in os.listdir(directory):
             fullpath = os.path.join(directory, filename)
             with open(fullpath, 'r') as opt1:
                 with open(output_fastqs, 'a') as opt2:
-                    opt2.write(opt1.read())
+                    metrics.add_bytes(stream_fastq(opt1, opt2, indexer))
+        indexer.write()
+        metrics.done('concatenate')
+    profile_stop('concatenate')
     print ''
     print 'Done!'
     print ''
@@ -310,12 +1485,16 @@ if not args.unicycler:
             os.mkdir(unclassporechopout)
         print colours.invoking + 'Concatenating Unclassified Reads...' + colours.term
         print ''
+        profile_start('concatenate_unclassified')
+        indexer = FastqIndexer(unclassoutput)
         for directory in unclassifiedinput:
             for filename in os.listdir(directory):
                 fullpath = os.path.join(directory, filename)
                 with open(fullpath, 'r') as opt1:
                     with open(unclassoutput, 'a') as opt2:
-                        opt2.write(opt1.read())
+                        metrics.add_bytes(stream_fastq(opt1, opt2, indexer))
+        indexer.write()
+        profile_stop('concatenate_unclassified')
         print ''
         print 'Done!'
         print ''
@@ -337,9 +1516,9 @@ if not args.unicycler:
     print colours.invoking + 'Invoking porechop...' + colours.term
     print ''
     time.sleep(1)
+    metrics.begin('porechop', len(rawfastqs) + (1 if args.merge else 0))
     try:
-        for opt1, opt2 in zip(rawfastqs, porechopout):
-            subprocess.check_call(['porechop', '-i', opt1, '-b', opt2])
+        supervise('porechop', [porechop_job(x, y) for x, y in zip(rawfastqs, porechopout)])
     except Exception as e:
         print colours.warning + ''
         print 'Porechop failed to run'
@@ -352,14 +1531,24 @@ if not args.unicycler:
         scriptfail()
         sys.exit(1)
 
+    # Drop samples that failed Porechop (-k)
+    if args.keep_going:
+        cat_names = [x[:-len('.fastq')] for x in raw_cat_fastq_names]
+        samples, barcodes, sample_numbers, raw_cat_fastq_names, rawfastqs, porechopout, porechopsamples, pathedporechopsamples, genome_sizes = keep_passed('porechop', cat_names, samples, barcodes, sample_numbers, raw_cat_fastq_names, rawfastqs, porechopout, porechopsamples, pathedporechopsamples, genome_sizes)
+        if args.hybrid:
+            Illumina_R1, Illumina_R2 = keep_passed('porechop', cat_names, Illumina_R1, Illumina_R2)
+
     # List creation
     finalchoppedreads = [porechoppedreads + '/' + x for x in raw_cat_fastq_names]
 
     # Default (i.e. no merge) fastq collection and rename.
     if not args.merge:
+        profile_start('collect_reads')
         try:
             for opt1, opt2 in zip(pathedporechopsamples, finalchoppedreads):
-                shutil.copyfile(opt1, opt2)
+                digest = new_digest()
+                copy_fastq(opt1, opt2, digest)
+                manifest_add(opt2, digest)
         except Exception as e:
             print ''
             print colours.warning + 'Failed to copy and rename reads.'
@@ -369,6 +1558,7 @@ if not args.unicycler:
             print ''
             scriptfail()
             sys.exit(1)
+        profile_stop('collect_reads')
         print ''
         print colours.blue + 'Porechopped files succesfully renamed and written to: ' + colours.term,
         print porechoppedreads
@@ -381,7 +1571,7 @@ if not args.unicycler:
         unclassifiedsamples = ['UC' + x + '.fastq' for x in sample_numbers]
         unclassifiedsampledestination = [unclassporechopout + "/" + x for x in unclassifiedsamples]
         try:
-            subprocess.check_call(['porechop', '-i', unclassoutput, '-b', unclassporechopout])
+            porechop(unclassoutput, unclassporechopout)
         except Exception as e:
             print colours.warning + ''
             print 'Failed to invoke porechop on unclassified reads'
@@ -422,14 +1612,20 @@ if not args.unicycler:
         # cat unclasssampdest + porechoppedreads >> finalchoppedreads
         print colours.invoking + 'Concatenating Reads...' + colours.term
         print ''
+        profile_start('merge_reads')
         for file1, file2, fileout in zip(pathedporechopsamples,unclassifiedsampledestination, finalchoppedreads):
             try:
+                indexer = FastqIndexer(fileout)
+                # Appending to earlier content can't be hashed in stream, the manifest picks it up later
+                digest = new_digest() if indexer.position == 0 else None
                 with open (file1, 'r') as in1:
                     with open (file2, 'r') as in2:
                         with open (fileout, 'a') as out:
-                            out.write(in1.read())
-                            out.write(in2.read())
+                            stream_fastq(in1, out, indexer, digest)
+                            stream_fastq(in2, out, indexer, digest)
                             print '.',
+                indexer.write()
+                manifest_add(fileout, digest)
             except Exception as e:
                 print ''
                 print 'Failed to locate or read Porechop output.'
@@ -440,33 +1636,43 @@ if not args.unicycler:
                 print ''
                 scriptfail()
                 sys.exit(1)
+        profile_stop('merge_reads')
         print ''
         print ''
         print colours.blue + 'Merged files succesfully written to: ' + colours.term,
         print porechoppedreads
         print ''
 
+    # Sample manifest for chained Unicycler only runs (-u)
+    write_sample_manifest([x[:-len('.fastq')] for x in raw_cat_fastq_names], barcodes, finalchoppedreads,
+                          Illumina_R1 if args.hybrid else [None] * len(samples),
+                          Illumina_R2 if args.hybrid else [None] * len(samples), genome_sizes)
+    print colours.blue + 'Sample manifest for Unicycler only reruns (-u) written to: ' + colours.term,
+    print out_path + '/' + sample_manifest
+    print ''
+
     # Porechop completion and exit (-p)
     if args.porechop:
         print colours.invoking + colours.bold + ''
-        print 'Porechop completed successfully!'
+        print completion_message('Porechop', 'porechop')
         print '' + colours.term
         print ''
         time.sleep(2)
         print ''
         print ''
+        run_summary()
+        write_manifest()
+        final_metrics(1)
+        print ''
         print 'Author: www.github.com/stevenjdunn'
         print ''
-        print colours.bold + ''
-        print '####################'
-        print 'PoreCycler Complete!'
-        print '####################' + colours.term
+        completion_banner()
         print ''
         exit(1)
 
     # Porechop completion and continuation
     print colours.invoking + colours.bold + ''
-    print 'Porechop completed successfully!'
+    print completion_message('Porechop', 'porechop')
     print '' + colours.term
     print ''
     time.sleep(2)
@@ -477,6 +1683,10 @@ if not args.unicycler:
     print ''
     print ''
 
+    # Subsample Illumina reads (-ss)
+    if args.hybrid and args.subsample:
+        Illumina_R1, Illumina_R2 = subsample_stage()
+
     # Invoke unicycler
     unipath = (out_path + '/unicycler/')
     if not os.path.exists(unipath):
@@ -492,106 +1702,32 @@ if not args.unicycler:
     print colours.invoking + 'Invoking Unicycler...' + colours.term
     print ''
     time.sleep(1)
+    metrics.begin('unicycler', len(unioutdirs))
 
-    # Long read only
-    if not args.hybrid and not args.conservative and not args.bold:
-        try:
-            for opt1, opt2 in zip(finalchoppedreads, unioutdirs):
-                subprocess.check_call(['unicycler', '-l', opt1, '-o', opt2])
-        except Exception as e:
-                        print ''
-                        print colours.warning + 'Failed to invoke Unicycler.'
-                        print ''
-                        print (e)
-                        print ''
-                        print 'Check logs to troubleshoot. #E1'
-                        print ''
-                        scriptfail()
-                        sys.exit(1)
-
-    # Long read + conservative
-    if args.conservative and not args.hybrid:
-        try:
-            for opt1, opt2 in zip(finalchoppedreads, unioutdirs):
-                subprocess.check_call(['unicycler', '--mode', 'conservative','-l', opt1, '-o', opt2])
-        except Exception as e:
-                        print ''
-                        print colours.warning + 'Failed to invoke Unicycler.'
-                        print ''
-                        print (e)
-                        print ''
-                        print 'Check logs to troubleshoot. #E2'
-                        print ''
-                        scriptfail()
-                        sys.exit(1)
-
-    # Long read + bold
-    if args.bold and not args.hybrid:
-        try:
-            for opt1, opt2 in zip(finalchoppedreads, unioutdirs):
-                subprocess.check_call(['unicycler', '--mode', 'bold','-l', opt1, '-o', opt2])
-        except Exception as e:
-                        print ''
-                        print colours.warning + 'Failed to invoke Unicycler.'
-                        print ''
-                        print (e)
-                        print ''
-                        print 'Check logs to troubleshoot. #E3'
-                        print ''
-                        scriptfail()
-                        sys.exit(1)
-    # Hybrid only
-    if args.hybrid and not args.conservative and not args.bold:
-        try:
-            for opt1, opt2, opt3, opt4 in zip(finalchoppedreads, Illumina_R1, Illumina_R2, unioutdirs):
-                subprocess.check_call(['unicycler', '-1', opt2, '-2', opt3, '-l', opt1, '-o', opt4])
-        except Exception as e:
-                        print ''
-                        print colours.warning + 'Failed to invoke Unicycler.'
-                        print ''
-                        print (e)
-                        print ''
-                        print 'Check logs to troubleshoot. #E4'
-                        print ''
-                        scriptfail()
-                        sys.exit(1)
-
-    # Hybrid + conservative
-    if args.hybrid and args.conservative:
-        try:
-            for opt1, opt2, opt3, opt4 in zip(finalchoppedreads, Illumina_R1, Illumina_R2, unioutdirs):
-                subprocess.check_call(['unicycler', '--mode', 'conservative', '-1', opt2, '-2', opt3, '-l', opt1, '-o', opt4])
-        except Exception as e:
-                        print ''
-                        print colours.warning + 'Failed to invoke Unicycler.'
-                        print ''
-                        print (e)
-                        print ''
-                        print 'Check logs to troubleshoot. #E5'
-                        print ''
-                        scriptfail()
-                        sys.exit(1)
-
-    # Hybrid + bold
-    if args.hybrid and args.bold:
-        try:
-            for opt1, opt2, opt3, opt4 in zip(finalchoppedreads, Illumina_R1, Illumina_R2, unioutdirs):
-                subprocess.check_call(['unicycler', '--mode', 'bold', '-1', opt2, '-2', opt3, '-l', opt1, '-o', opt4])
-        except Exception as e:
-                        print ''
-                        print colours.warning + 'Failed to invoke Unicycler.'
-                        print ''
-                        print (e)
-                        print ''
-                        print 'Check logs to troubleshoot. #E6'
-                        print ''
-                        scriptfail()
-                        sys.exit(1)
+    # Long read only, or hybrid with Illumina reads, in normal/conservative/bold mode
+    if args.hybrid:
+        unicyclerjobs = [unicycler_job(w, x, y, z) for w, x, y, z in zip(finalchoppedreads, unioutdirs, Illumina_R1, Illumina_R2)]
+    else:
+        unicyclerjobs = [unicycler_job(x, y) for x, y in zip(finalchoppedreads, unioutdirs)]
+    if args.min_coverage is not None:
+        unicyclerjobs = coverage_gate(unicyclerjobs, finalchoppedreads, genome_sizes)
+    try:
+        supervise('unicycler', unicyclerjobs)
+    except Exception as e:
+        print ''
+        print colours.warning + 'Failed to invoke Unicycler.'
+        print ''
+        print (e)
+        print ''
+        print 'Check logs to troubleshoot. ' + unicycler_code()
+        print ''
+        scriptfail()
+        sys.exit(1)
 
     # Unicycler completion message
     print ''
     print ''
-    print colours.invoking + colours.bold + 'Unicycler completed successfully!' + colours.term
+    print colours.invoking + colours.bold + completion_message('Unicycler', 'unicycler') + colours.term
     print ''
     time.sleep(3)
 
@@ -619,11 +1755,49 @@ if args.unicycler:
     print ''
     print colours.invoking + 'Processing input csv...' + colours.term
     time.sleep(1)
-    if args.hybrid:
+
+    # Import sample names + read paths from a previous run's sample manifest
+    if chained:
+        rows = load_sample_manifest(chained)
+        samples = [x['sample'] for x in rows]
+        Minion_in = [x['reads'] for x in rows]
+        genome_sizes = [x['genome_size'] or None for x in rows]
+        print ''
+        print colours.blue + 'Loaded sample manifest:' + colours.term,
+        print chained
+        print ''
+        print colours.blue + 'Loaded sample names:' + colours.term,
+        print samples
+        print ''
+        if args.hybrid:
+            Illumina_R1 = [x['illumina_r1'] for x in rows]
+            Illumina_R2 = [x['illumina_r2'] for x in rows]
+            if '' in Illumina_R1 + Illumina_R2:
+                print colours.warning + 'The previous run did not record Illumina reads for every sample.'
+                print ''
+                print 'Remove the -hyb flag, or use an input CSV listing the Illumina reads.' + colours.term
+                print '#IU3'
+                scriptfail()
+                sys.exit(1)
+            print colours.blue + "Loaded Illumina R1:" + colours.term,
+            print Illumina_R1
+            print colours.blue + "Loaded Illumina R2:" + colours.term,
+            print Illumina_R2
+            print ''
+        missing = [x for x in Minion_in if not os.path.exists(x)]
+        if missing:
+            print colours.warning + 'MinION reads listed in the sample manifest were not found:' + colours.term
+            print missing
+            print '#IU4'
+            scriptfail()
+            sys.exit(1)
+
+    if args.hybrid and not chained:
         try:
             with open(args.input, 'rbU') as f:
                 reader = csv.reader(f, skipinitialspace=True, delimiter=',')
-                a, b, c, d = zip(*reader)
+                rows, genome_sizes = split_genome_sizes(list(reader), 4)
+                a, b, c, d = zip(*rows)
                 samples = list(a)
                 Min_R = list(b)
                 Ill_R1 = list(c)
@@ -654,17 +1828,18 @@ if args.unicycler:
             sys.exit(1)
 
     # Import barcodes + sample names only
-    if not args.hybrid:
+    if not args.hybrid and not chained:
             try:
                 with open(args.input, 'rbU') as f:
                     reader = csv.reader(f, skipinitialspace=True, delimiter=',')
-                    a, b = zip(*reader)
+                    rows, genome_sizes = split_genome_sizes(list(reader), 2)
+                    a, b = zip(*rows)
                     samples = list(a)
                     Min_R = list(b)
                     print ''
                     print ''
                     print colours.blue + 'Loaded sample names:' + colours.term
-                    print barcodes
+                    print samples
                     print ''
                     print ''
                     print colours.blue + 'Loaded Minion read filenames:' + colours.term
@@ -703,11 +1878,14 @@ if args.unicycler:
                         print ''
                         scriptfail()
                         sys.exit(1)
+    check_genome_sizes(genome_sizes, '#IU5')
+
     # List Generation
     unipath = (out_path + '/unicycler/')
     unioutdirs = [unipath + x for x in samples]
-    Minion_in = [target_path + '/' + x for x in Min_R]
-    if args.hybrid:
+    if not chained:
+        Minion_in = [target_path + '/' + x for x in Min_R]
+    if args.hybrid and not chained:
         Illumina_R1 = [sbspath + '/' + x for x in Ill_R1]
         Illumina_R2 = [sbspath + '/' + x for x in Ill_R2]
     graphs = [x + '/assembly.gfa' for x in unioutdirs]
@@ -726,6 +1904,10 @@ if args.unicycler:
     assemblies_target = [assembly_path + '/' + x + '.fasta' for x in samples]
     logs_target = [log_path + '/' + x + '_unicycler.log' for x in samples]
 
+    # Subsample Illumina reads (-ss)
+    if args.hybrid and args.subsample:
+        Illumina_R1, Illumina_R2 = subsample_stage()
+
     # Invoke unicycler
     if not os.path.exists(unipath):
         os.mkdir(unipath)
@@ -736,131 +1918,62 @@ if args.unicycler:
     print colours.invoking + 'Invoking Unicycler...' + colours.term
     print ''
     time.sleep(1)
+    metrics.begin('unicycler', len(unioutdirs))
 
-    # Long read only
-    if not args.hybrid and not args.conservative and not args.bold:
-        try:
-            for opt1, opt2 in zip(Minion_in, unioutdirs):
-                subprocess.check_call(['unicycler', '-l', opt1, '-o', opt2])
-        except Exception as e:
-                        print ''
-                        print colours.warning + 'Failed to invoke Unicycler.'
-                        print ''
-                        print (e)
-                        print ''
-                        print 'Check logs to troubleshoot. #E1'
-                        print ''
-                        scriptfail()
-                        sys.exit(1)
-
-    # Long read + conservative
-    if args.conservative and not args.hybrid:
-        try:
-            for opt1, opt2 in zip(Minion_in, unioutdirs):
-                subprocess.check_call(['unicycler', '--mode', 'conservative','-l', opt1, '-o',opt2])
-        except Exception as e:
-                        print ''
-                        print colours.warning + 'Failed to invoke Unicycler.'
-                        print ''
-                        print (e)
-                        print ''
-                        print 'Check logs to troubleshoot. #E2'
-                        print ''
-                        scriptfail()
-                        sys.exit(1)
-
-    # Long read + bold
-    if args.bold and not args.hybrid:
-        try:
-            for opt1, opt2 in zip(Minion_in, unioutdirs):
-                subprocess.check_call(['unicycler', '--mode', 'bold','-l', opt1, '-o', opt2])
-        except Exception as e:
-                        print ''
-                        print colours.warning + 'Failed to invoke Unicycler.'
-                        print ''
-                        print (e)
-                        print ''
-                        print 'Check logs to troubleshoot. #E3'
-                        print ''
-                        scriptfail()
-                        sys.exit(1)
-
-    # Hybrid only
-    if args.hybrid and not args.conservative and not args.bold:
-        try:
-            for opt1, opt2, opt3, opt4 in zip(Minion_in, Illumina_R1, Illumina_R2, unioutdirs):
-                subprocess.check_call(['unicycler', '-1', opt2, '-2', opt3, '-l', opt1, '-o', opt4])
-        except Exception as e:
-                        print ''
-                        print colours.warning + 'Failed to invoke Unicycler.'
-                        print ''
-                        print (e)
-                        print ''
-                        print 'Check logs to troubleshoot. #E4'
-                        print ''
-                        scriptfail()
-                        sys.exit(1)
-
-    # Hybrid + conservative
-    if args.hybrid and args.conservative:
-        try:
-            for opt1, opt2, opt3, opt4 in zip(Minion_in, Illumina_R1, Illumina_R2, unioutdirs):
-                subprocess.check_call(['unicycler', '--mode', 'conservative', '-1', opt2, '-2', opt3, '-l', opt1, '-o', opt4])
-        except Exception as e:
-                        print ''
-                        print colours.warning + 'Failed to invoke Unicycler.'
-                        print ''
-                        print (e)
-                        print ''
-                        print 'Check logs to troubleshoot. #E5'
-                        print ''
-                        scriptfail()
-                        sys.exit(1)
-
-    # Hybrid + bold
-    if args.hybrid and args.bold:
-        try:
-            for opt1, opt2, opt3, opt4 in zip(Minion_in, Illumina_R1, Illumina_R2, unioutdirs):
-                subprocess.check_call(['unicycler', '--mode', 'bold', '-1', opt2, '-2', opt3, '-l', opt1, '-o', opt4])
-        except Exception as e:
-                        print ''
-                        print colours.warning + 'Failed to invoke Unicycler.'
-                        print ''
-                        print (e)
-                        print ''
-                        print 'Check logs to troubleshoot. #E6'
-                        print ''
-                        scriptfail()
-                        sys.exit(1)
+    # Long read only, or hybrid with Illumina reads, in normal/conservative/bold mode
+    if args.hybrid:
+        unicyclerjobs = [unicycler_job(w, x, y, z) for w, x, y, z in zip(Minion_in, unioutdirs, Illumina_R1, Illumina_R2)]
+    else:
+        unicyclerjobs = [unicycler_job(x, y) for x, y in zip(Minion_in, unioutdirs)]
+    if args.min_coverage is not None:
+        unicyclerjobs = coverage_gate(unicyclerjobs, Minion_in, genome_sizes)
+    try:
+        supervise('unicycler', unicyclerjobs)
+    except Exception as e:
+        print ''
+        print colours.warning + 'Failed to invoke Unicycler.'
+        print ''
+        print (e)
+        print ''
+        print 'Check logs to troubleshoot. ' + unicycler_code()
+        print ''
+        scriptfail()
+        sys.exit(1)
 
     # Unicycler completion message
     print ''
     print ''
-    print colours.invoking + colours.bold + 'Unicycler completed successfully!' + colours.term
+    print colours.invoking + colours.bold + completion_message('Unicycler', 'unicycler') + colours.term
     print ''
     time.sleep(3)
 
 
+# Drop samples that failed or were skipped before assembly (-k / -mc)
+if args.keep_going or args.min_coverage is not None:
+    assemblies, assemblies_target, graphs, graph_target, logs, logs_target = keep_passed('unicycler', [os.path.basename(x) for x in unioutdirs], assemblies, assemblies_target, graphs, graph_target, logs, logs_target)
+
 # Rename and collect assemblies
+profile_start('collect_assemblies')
 for opt1, opt2 in zip(assemblies, assemblies_target):
-    shutil.copyfile(opt1, opt2)
+    collect_file(opt1, opt2)
 print ''
 print colours.blue + 'Assemblies renamed and placed in: ' + colours.term,
 print assembly_path
 
 # Rename and collect graphs
 for opt1, opt2 in zip(graphs, graph_target):
-    shutil.copyfile(opt1, opt2)
+    collect_file(opt1, opt2)
 print ''
 print colours.blue + 'Assembly graphs renamed and placed in: ' + colours.term,
 print graph_path
 
 # Rename and collect logs
 for opt1, opt2 in zip(logs, logs_target):
-    shutil.copyfile(opt1, opt2)
+    collect_file(opt1, opt2)
 print ''
 print colours.blue + 'Unicycler logs renamed and placed in: ' + colours.term,
 print log_path
+profile_stop('collect_assemblies')
 
 # Remove intermediate files
 if args.remove:
@@ -880,14 +1993,21 @@ if args.remove:
 # Possible future plans:
     # Parse unicycler output logs to detect errors.
     # Create summary report with assembly metrics.
-    # Write output file containing final read names for use in assembly only argument.
+
+# Pass/fail matrix
+run_summary()
+
+# Checksum manifest
+write_manifest()
+
+# Final metrics update
+final_metrics(1 if failed_samples() else 0)
 
 # Script ending
 print ''
 print ''
 print 'Author: www.github.com/stevenjdunn'
 print ''
-print colours.bold + ''
-print '####################'
-print 'PoreCycler Complete!'
-print '####################' + colours.term
+if completion_banner():
+    print ''
+    sys.exit(1)